@@ -9,19 +9,24 @@ Charts:
 Features:
 - Gmail IMAP
 - 24 hour caching
+- Incremental refresh (only new mail is fetched)
 - Consistent ordering
 """
 
 import imaplib
 import email
+import json
 import os
 import re
-from collections import Counter, OrderedDict
+import threading
+from collections import Counter
 from datetime import datetime, timedelta
+from email.parser import BytesHeaderParser
+from typing import Optional
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import Response
 
 # -----------------------------
 # CONFIG
@@ -33,6 +38,30 @@ PASSWORD = os.getenv("PASSWORDA")
 
 CACHE_INTERVAL = timedelta(hours=24)
 
+SUB_REQUEST_SENDER = "sandiego-cv@aopsacademy.org"
+
+# Only search mail received within this window
+SEARCH_WINDOW = timedelta(days=60)
+
+# IMAP dates always use English month names, whatever the locale
+IMAP_MONTHS = [
+    "Jan", "Feb", "Mar", "Apr", "May", "Jun",
+    "Jul", "Aug", "Sep", "Oct", "Nov", "Dec",
+]
+
+# Seconds to wait on the IMAP socket before giving up on a refresh
+IMAP_TIMEOUT = 30
+
+# Max message ids per FETCH command (keeps requests under server limits)
+FETCH_BATCH_SIZE = 100
+
+# Only the headers needed to read the subject and decode the body,
+# plus the body itself. PEEK keeps messages unread.
+FETCH_ITEMS = (
+    "(BODY.PEEK[HEADER.FIELDS (SUBJECT CONTENT-TYPE CONTENT-TRANSFER-ENCODING)]"
+    " BODY.PEEK[TEXT])"
+)
+
 VALID_CLASSES = [
     "Math Level 1",
     "Math Level 2",
@@ -47,6 +76,16 @@ VALID_CLASSES = [
     "Calculus",
 ]
 
+# Every real sub request email contains this sentence
+SUB_REQUEST_MARKER = "A substitute has been requested for"
+SUB_REQUEST_MARKER_BYTES = SUB_REQUEST_MARKER.encode()
+
+# Bodies in these encodings can't be searched before decoding
+ENCODED_BODY_RE = re.compile(
+    rb"content-transfer-encoding:\s*(?:base64|quoted-printable)",
+    re.IGNORECASE,
+)
+
 WEEKDAY_ORDER = [
     "Monday",
     "Tuesday",
@@ -57,6 +96,27 @@ WEEKDAY_ORDER = [
     "Sunday",
 ]
 
+# Longest names first so a longer class name wins over any name it contains
+# at the same position
+CLASS_RE = re.compile(
+    "|".join(
+        re.escape(cls) for cls in sorted(VALID_CLASSES, key=len, reverse=True)
+    ),
+    re.IGNORECASE,
+)
+CLASS_BY_LOWER = {cls.lower(): cls for cls in VALID_CLASSES}
+CLASS_PRIORITY = {cls: i for i, cls in enumerate(VALID_CLASSES)}
+
+# UID reported in a UID FETCH response
+UID_RE = re.compile(rb"UID (\d+)")
+
+# Bounded gap between the day and the start time to limit backtracking
+TIME_SLOT_RE = re.compile(
+    r"begins (\w+) [^\n]{0,120}? at (\d{1,2}:\d{2})\s*(?:am|pm)? "
+    r"and ends at (\d{1,2}:\d{2})\s*(?:am|pm)?",
+    re.IGNORECASE,
+)
+
 # -----------------------------
 # APP SETUP
 # -----------------------------
@@ -73,11 +133,40 @@ app.add_middleware(
 # -----------------------------
 # CACHE
 # -----------------------------
-_cached_time_slots = None
-_cached_class_counts = None
-_cached_days = None
+_slot_counts = Counter()
+_class_counts = Counter()
+_day_counts = Counter()
 _cached_time = None
 
+# Serialized responses, rebuilt on each refresh
+_cached_json_slots = None
+_cached_json_classes = None
+_cached_json_days = None
+_cache_lock = threading.Lock()
+
+# Held while a refresh is running, so only one runs at a time
+_refresh_lock = threading.Lock()
+
+# Parse result of each of the last 200 sub request mails, by UID,
+# valid only for this mailbox UIDVALIDITY
+_parsed_by_uid = {}
+_uid_validity = None
+
+# -----------------------------
+# IMAP CONNECTION
+# -----------------------------
+def connect_mail():
+    """Open an IMAP connection on the inbox.
+
+    Returns the connection and the inbox UIDVALIDITY.
+    """
+    mail = imaplib.IMAP4_SSL(IMAP_SERVER, IMAP_PORT, timeout=IMAP_TIMEOUT)
+    mail.login(USERNAME, PASSWORD)
+    mail.select("inbox")
+
+    _, data = mail.response("UIDVALIDITY")
+    return mail, data[0]
+
 
 # -----------------------------
 # HELPERS
@@ -86,139 +175,326 @@ def extract_class_from_subject(subject: str):
     if not subject:
         return None
 
-    subject = subject.lower()
+    # A subject can name several classes: the first in VALID_CLASSES wins
+    matches = [
+        CLASS_BY_LOWER[match.group(0).lower()]
+        for match in CLASS_RE.finditer(subject)
+    ]
+
+    return min(matches, key=CLASS_PRIORITY.__getitem__, default=None)
+
+
+def to_json_bytes(content):
+    # Same encoding JSONResponse uses
+    return json.dumps(
+        content,
+        ensure_ascii=False,
+        allow_nan=False,
+        indent=None,
+        separators=(",", ":"),
+    ).encode("utf-8")
+
 
-    for cls in VALID_CLASSES:
-        if cls.lower() in subject:
-            return cls
+def may_be_sub_request(header: bytes, text: bytes):
+    """Cheap check on the raw bytes, before any MIME parsing.
 
-    return None
+    Only a miss on a plain (not base64/quoted-printable) body is trusted.
+    """
+    if text.find(SUB_REQUEST_MARKER_BYTES) != -1:
+        return True
+
+    return (
+        ENCODED_BODY_RE.search(header) is not None
+        or ENCODED_BODY_RE.search(text) is not None
+    )
+
+
+def fetch_raw_messages(mail, uids):
+    """Fetch messages in batches.
+
+    Returns a dict from UID to a (header, text) pair of raw bytes for each
+    message: its selected header fields and its undecoded text body.
+    """
+    raw_messages = {}
+
+    for i in range(0, len(uids), FETCH_BATCH_SIZE):
+        batch = uids[i:i + FETCH_BATCH_SIZE]
+        _, msg_data = mail.uid(
+            "fetch", ",".join(str(uid) for uid in batch), FETCH_ITEMS
+        )
+
+        # Each message comes back as one (item, payload) tuple per fetch
+        # item, followed by a closing b")" token. The UID can be reported
+        # in any of them. Unsolicited responses such as a FLAGS update
+        # carry a UID but no payload, and are skipped.
+        uid = None
+        header = None
+        text = None
+        for part in msg_data:
+            item = part[0] if isinstance(part, tuple) else part
+            match = UID_RE.search(item)
+            if match:
+                uid = int(match.group(1))
+
+            if isinstance(part, tuple):
+                if b"HEADER.FIELDS" in item.upper():
+                    header = part[1]
+                else:
+                    text = part[1]
+                continue
+
+            # Never let an empty response replace one already collected
+            has_payload = header is not None or text is not None
+            replaces_real = uid in raw_messages and not (header or text)
+            if uid is not None and has_payload and not replaces_real:
+                raw_messages[uid] = (header or b"", text or b"")
+
+            uid = None
+            header = None
+            text = None
+
+    return raw_messages
 
 
 # -----------------------------
 # FETCH + PARSE EMAILS
 # -----------------------------
-def fetch_last_200_sub_requests():
-    mail = imaplib.IMAP4_SSL(IMAP_SERVER, IMAP_PORT)
-    mail.login(USERNAME, PASSWORD)
-    mail.select("inbox")
-
-    status, data = mail.search(
-        None, '(FROM "sandiego-cv@aopsacademy.org")'
+def imap_date(date):
+    return f"{date.day:02d}-{IMAP_MONTHS[date.month - 1]}-{date.year}"
+
+
+def search_sub_request_uids(mail):
+    """Return the UIDs of the last 200 sub request mails, oldest first."""
+    # Let the server filter by sender, date and body text
+    since_date = imap_date(datetime.now() - SEARCH_WINDOW)
+    status, data = mail.uid(
+        "search",
+        None,
+        "FROM", f'"{SUB_REQUEST_SENDER}"',
+        "SINCE", since_date,
+        "BODY", f'"{SUB_REQUEST_MARKER}"',
     )
-    email_ids = data[0].split()[-200:]
 
-    time_slots = []
-    class_names = []
-    days_only = []
+    return sorted(int(uid) for uid in data[0].split())[-200:]
+
+
+def parse_sub_request(raw_message):
+    """Parse one fetched (header, text) pair.
+
+    Returns (time_slot, day, class_name) for a real sub request, with
+    None for any part that couldn't be found, or None otherwise.
+    """
+    header, text = raw_message
+
+    if not may_be_sub_request(header, text):
+        return None
 
-    for e_id in email_ids:
-        _, msg_data = mail.fetch(e_id, "(RFC822)")
-        raw_email = msg_data[0][1]
-        msg = email.message_from_bytes(raw_email)
+    # Stops at the end of the headers, no MIME tree is built
+    headers = BytesHeaderParser().parsebytes(header)
 
-        subject = msg["subject"] or ""
+    subject = headers["subject"] or ""
 
-        # BODY
-        body = ""
+    # BODY
+    encoding = (headers["content-transfer-encoding"] or "7bit").strip().lower()
+    if headers.get_content_maintype() != "multipart" and encoding in (
+        "7bit", "8bit", "binary"
+    ):
+        # Plain single part body: the fetched text is the payload
+        body = text.decode(
+            headers.get_content_charset() or "utf-8",
+            errors="ignore",
+        )
+    else:
+        # Multipart or transfer-encoded: let the email parser decode it
+        msg = email.message_from_bytes(header + text)
         if msg.is_multipart():
+            body_parts = []
             for part in msg.walk():
                 if part.get_content_type() == "text/plain":
-                    body += part.get_payload(decode=True).decode(
+                    payload = part.get_payload(decode=True)
+                    body_parts.append(payload.decode(
                         part.get_content_charset() or "utf-8",
                         errors="ignore",
-                    )
+                    ))
+            body = "".join(body_parts)
         else:
             body = msg.get_payload(decode=True).decode(
                 msg.get_content_charset() or "utf-8",
                 errors="ignore",
             )
 
-        # Must be real sub request
-        if "A substitute has been requested for" not in body:
-            continue
+    # Must be real sub request
+    if SUB_REQUEST_MARKER not in body:
+        return None
 
-        # TIME SLOT
-        match = re.search(
-            r"begins (\w+) .*? at (\d{1,2}:\d{2})\s*(am|pm)? "
-            r"and ends at (\d{1,2}:\d{2})\s*(am|pm)?",
-            body,
-            re.IGNORECASE,
-        )
+    # TIME SLOT
+    time_slot = None
+    day = None
+    match = TIME_SLOT_RE.search(body)
 
-        if match:
-            day = match.group(1)
-            start_time = match.group(2)
-            end_time = match.group(4)
+    if match:
+        day = match.group(1)
+        start_time = match.group(2)
+        end_time = match.group(3)
 
-            time_slots.append(f"{day} {start_time} - {end_time}")
-            days_only.append(day)
+        time_slot = f"{day} {start_time} - {end_time}"
 
-        # CLASS
-        class_name = extract_class_from_subject(subject)
-        if class_name:
-            class_names.append(class_name)
+    # CLASS
+    class_name = extract_class_from_subject(subject)
+
+    return time_slot, day, class_name
+
+
+def fetch_last_200_sub_requests(parsed_by_uid, uid_validity):
+    """Return the parse results of the last 200 sub request mails by UID.
+
+    parsed_by_uid holds the results from the previous refresh, taken when
+    the inbox had uid_validity. Only mail missing from it is fetched.
+    Returns the new results and the current inbox UIDVALIDITY.
+    """
+    mail, mailbox_validity = connect_mail()
+    try:
+        if mailbox_validity != uid_validity:
+            # UIDs were renumbered, so earlier results can't be matched up
+            parsed_by_uid = {}
 
-    mail.logout()
-    return time_slots, class_names, days_only
+        uids = search_sub_request_uids(mail)
+        new_uids = [uid for uid in uids if uid not in parsed_by_uid]
+        raw_messages = fetch_raw_messages(mail, new_uids)
+    finally:
+        try:
+            mail.logout()
+        except (imaplib.IMAP4.error, OSError):
+            pass
+
+    results = [parse_sub_request(raw) for raw in raw_messages.values()]
+
+    parsed_by_uid = {**parsed_by_uid, **dict(zip(raw_messages, results))}
+
+    # Drops mail that has left the last 200, or the inbox
+    return (
+        {uid: parsed_by_uid[uid] for uid in uids if uid in parsed_by_uid},
+        mailbox_validity,
+    )
 
 
 # -----------------------------
 # CACHE HANDLER
 # -----------------------------
 def refresh_cache():
-    global _cached_time_slots, _cached_class_counts, _cached_days, _cached_time
+    global _slot_counts, _class_counts, _day_counts, _cached_time
+    global _parsed_by_uid, _uid_validity
+    global _cached_json_slots, _cached_json_classes, _cached_json_days
+
+    parsed_by_uid, uid_validity = fetch_last_200_sub_requests(
+        _parsed_by_uid, _uid_validity
+    )
 
-    slots, classes, days = fetch_last_200_sub_requests()
+    slot_counts = Counter()
+    class_counts = Counter()
+    day_counts = Counter()
 
-    # Time slots
-    _cached_time_slots = dict(Counter(slots))
+    for result in parsed_by_uid.values():
+        if result is None:
+            continue
 
-    # Class counts (ordered)
-    counts = Counter(classes)
-    ordered_counts = OrderedDict()
-    for cls in VALID_CLASSES:
-        ordered_counts[cls] = counts.get(cls, 0)
-    _cached_class_counts = dict(ordered_counts)
+        time_slot, day, class_name = result
 
-    # Days only (ordered weekdays)
-    day_counts = Counter(days)
-    ordered_days = OrderedDict()
-    for day in WEEKDAY_ORDER:
-        ordered_days[day] = day_counts.get(day, 0)
+        if time_slot:
+            slot_counts[time_slot] += 1
+            day_counts[day] += 1
 
-    _cached_days = dict(ordered_days)
+        if class_name:
+            class_counts[class_name] += 1
 
-    _cached_time = datetime.now()
+    # Counters are read by the endpoints, so swap them in under the lock
+    with _cache_lock:
+        _slot_counts = slot_counts
+        _class_counts = class_counts
+        _day_counts = day_counts
 
+        _parsed_by_uid = parsed_by_uid
+        _uid_validity = uid_validity
+
+        _cached_json_slots = to_json_bytes(dict(_slot_counts))
+
+        # Class counts (ordered)
+        _cached_json_classes = to_json_bytes(
+            {cls: _class_counts[cls] for cls in VALID_CLASSES}
+        )
+
+        # Days only (ordered weekdays)
+        _cached_json_days = to_json_bytes(
+            {day: _day_counts[day] for day in WEEKDAY_ORDER}
+        )
+
+        _cached_time = datetime.now()
 
-def ensure_cache():
-    global _cached_time
 
-    now = datetime.now()
-    if _cached_time is None or now - _cached_time > CACHE_INTERVAL:
+def cache_is_stale():
+    return (
+        _cached_time is None
+        or datetime.now() - _cached_time > CACHE_INTERVAL
+    )
+
+
+def refresh_in_background():
+    try:
         refresh_cache()
+    finally:
+        _refresh_lock.release()
+
+
+def ensure_cache():
+    """Make sure there is a cache to serve, refreshing stale data off-request.
+
+    Only the very first request waits on IMAP. After that a stale cache is
+    kept in service while a background thread refreshes it.
+    """
+    if _cached_time is None:
+        with _refresh_lock:
+            if _cached_time is None:
+                refresh_cache()
+        return
+
+    if cache_is_stale() and _refresh_lock.acquire(blocking=False):
+        # Another refresh may have finished since the check above
+        if not cache_is_stale():
+            _refresh_lock.release()
+            return
+
+        threading.Thread(target=refresh_in_background, daemon=True).start()
 
 
 # -----------------------------
 # API ENDPOINTS
 # -----------------------------
 @app.get("/api/sub_requests")
-def get_sub_requests():
+def get_sub_requests(top: Optional[int] = Query(None, ge=1)):
     ensure_cache()
-    return JSONResponse(content=_cached_time_slots)
+    with _cache_lock:
+        if top is None:
+            content = _cached_json_slots
+        else:
+            # Busiest time slots only, most requested first
+            content = to_json_bytes(dict(_slot_counts.most_common(top)))
+    return Response(content=content, media_type="application/json")
 
 
 @app.get("/api/class_breakdown")
 def get_class_breakdown():
     ensure_cache()
-    return JSONResponse(content=_cached_class_counts)
+    with _cache_lock:
+        content = _cached_json_classes
+    return Response(content=content, media_type="application/json")
 
 
 @app.get("/api/sub_requests_by_day")
 def get_sub_requests_by_day():
     ensure_cache()
-    return JSONResponse(content=_cached_days)
+    with _cache_lock:
+        content = _cached_json_days
+    return Response(content=content, media_type="application/json")
 
 
 # -----------------------------